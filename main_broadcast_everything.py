@@ -1,12 +1,22 @@
 # -*- coding: utf-8 -*-
+import os
+import tempfile # For atomic user data writes
+import pickle # For the parsed timetable/room links cache
 import time
 import asyncio
-import json
+import threading # For serializing user data saves across worker threads
 import logging
-from datetime import datetime, timedelta, time as dt_time # Alias time from datetime
-import pytz
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+import orjson # Fast JSON (de)serialization for timetable/user data
 import uuid # For generating unique IDs for custom lessons
 import re # For input validation (time, room)
+import functools # For caching cleaned room numbers
+import heapq # For the reminder queue
+import itertools # For unique reminder queue tie-breakers
+import bisect # For skipping lessons that already started
+from collections import OrderedDict # For self-trimming cooldown tracking
+from dataclasses import dataclass, field # For compact user records
 
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.client.default import DefaultBotProperties
@@ -14,8 +24,8 @@ from aiogram.filters import CommandStart, Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.enums import ParseMode
-from aiogram.exceptions import TelegramAPIError
+from aiogram.enums import ParseMode, ContentType
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter, TelegramForbiddenError, TelegramNotFound, TelegramBadRequest
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery # For keyboards
 from aiogram.filters import StateFilter # To handle /cancel command during FSM
 
@@ -33,18 +43,37 @@ USER_DATA_FILE = 'test_user_data.json'
 DEFAULT_NOTIFICATION_OFFSET_MINUTES = 10
 MIN_OFFSET_MINUTES = 1
 MAX_OFFSET_MINUTES = 120
-CHECK_INTERVAL_SECONDS = 60 # Check every 60 seconds
-TIMEZONE = pytz.timezone('Asia/Almaty')
-RATE_LIMIT_DELAY = 0.05 # Delay between messages in loops
-BROADCAST_RATE_LIMIT_DELAY = 0.1 # Delay for broadcast
-LEARN_NOTIFICATION_DELAY = 0.05 # Delay between sending learn notifications
+SCHEDULER_ERROR_BACKOFF_SECONDS = 30 # Extra pause after an unexpected scheduler error
+SCHEDULER_MAX_SLEEP_SECONDS = 900 # Upper bound on one scheduler sleep, so wall-clock jumps are picked up
+USER_DATA_FLUSH_INTERVAL_SECONDS = 10 # Minimum time between user data writes
+TIMEZONE = ZoneInfo('Asia/Almaty')
+GLOBAL_MESSAGES_PER_SECOND = 30 # Telegram's global bot send limit
+MAX_CONCURRENT_SENDS = 25 # Sends allowed in flight at once (broadcasts, reminder fan-out)
+SEND_MAX_ATTEMPTS = 3 # Attempts per message when Telegram asks us to retry later
 
 MAX_CUSTOM_LESSONS = 12 # Maximum custom lessons per user
+MAX_ROOM_INPUT_LENGTH = 32 # Longest room text accepted from users (/find, custom lessons)
 DAYS_OF_WEEK = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
-TIME_FORMAT_REGEX = re.compile(r"^([01]\d|2[0-3]):([0-5]\d)$") # HH:MM format
+DAYS_OF_WEEK_INDEX = {day: i for i, day in enumerate(DAYS_OF_WEEK)}
+DAY_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text=day, callback_data=f"add_day_{day}")] for day in DAYS_OF_WEEK])
+ROOM_PREFIX_REGEX = re.compile(r"[^(\n]*") # Room text before any '(' note or line break
+
+# Lower-case fragments of Telegram error descriptions (matched against the lower-cased message)
+UNREACHABLE_CHAT_ERROR_MARKERS = ("chat not found",) # 400 texts only; blocked/kicked/deactivated arrive as TelegramForbiddenError (403)
+INVALID_FILE_ID_ERROR_MARKERS = ("file_id_invalid", "invalid file identifier")
 
 # Static Learn Notification Text
 LEARN_NOTIFICATION_TEXT = "Do not forget to complete quizzes on https://learn.astanait.edu.kz/ ! :)"
+LEARN_NOTIFICATION_WEEKDAYS = (0, 2, 4) # Monday, Wednesday, Friday
+LEARN_NOTIFICATION_TIME = "19:40"
+
+# /timetable lesson entry
+TIMETABLE_LESSON_TEMPLATE = (
+    "<b>{lesson_key}. {subject}</b> ({lesson_type})\n"
+    "🕒 Time: {time_range}\n"
+    "👨‍🏫 Lecturer: {lecturer}\n"
+    "🚪 Room: {room}"
+)
 
 # --- Logging Setup ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -52,83 +81,227 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # --- Load Data ---
 def load_json_data(filename):
     try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        with open(filename, 'rb') as f:
+            return orjson.loads(f.read())
     except FileNotFoundError:
-        logging.error(f"Error: {filename} not found.")
+        logging.error("Error: %s not found.", filename)
         return {}
-    except json.JSONDecodeError:
-        logging.error(f"Error: Could not decode JSON from {filename}.")
+    except orjson.JSONDecodeError:
+        logging.error("Error: Could not decode JSON from %s.", filename)
         return {}
     except Exception as e:
-        logging.error(f"Unexpected error loading {filename}: {e}", exc_info=True)
+        logging.error("Unexpected error loading %s: %s", filename, e, exc_info=True)
         return {}
 
-timetable_data = load_json_data(TIMETABLE_FILE)
-room_links_data = load_json_data(ROOM_LINKS_FILE)
+def load_json_cached(filename):
+    """Like load_json_data, but reuses a pickled copy (<filename>.pkl) while the JSON file's mtime and size are unchanged.
+    Only for data the bot never modifies at runtime."""
+    try:
+        file_stat = os.stat(filename)
+    except OSError:
+        return load_json_data(filename)
+    stamp = (file_stat.st_mtime_ns, file_stat.st_size)
+    cache_file = f"{filename}.pkl"
+    try:
+        with open(cache_file, 'rb') as f:
+            cached_stamp, data = pickle.load(f)
+        if cached_stamp == stamp:
+            return data
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.warning("Ignoring unreadable cache %s: %s", cache_file, e)
+    data = load_json_data(filename)
+    if data:
+        try:
+            with open(cache_file, 'wb') as f:
+                pickle.dump((stamp, data), f, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError as e:
+            logging.warning("Could not write cache %s: %s", cache_file, e)
+    return data
+
+timetable_data = load_json_cached(TIMETABLE_FILE)
+room_links_data = load_json_cached(ROOM_LINKS_FILE)
+GROUP_KEY_INDEX = {key.upper(): key for key in timetable_data} # Case-insensitive group lookup
+
+def build_sorted_lesson_keys(timetable):
+    """Returns group -> day -> lesson keys in numeric order. Malformed days and non-numeric keys are logged and
+    skipped, so one bad entry can't stop the bot from starting; code walking the timetable should go through this index."""
+    index = {}
+    for group_number, days in timetable.items():
+        if not isinstance(days, dict):
+            logging.warning("Skipping timetable group %s: malformed schedule %r.", group_number, days)
+            continue
+        group_index = index[group_number] = {}
+        for day_name, day_schedule in days.items():
+            if not isinstance(day_schedule, dict):
+                logging.warning("Skipping timetable %s %s: malformed day %r.", group_number, day_name, day_schedule)
+                continue
+            lesson_keys = []
+            for lesson_key in day_schedule:
+                if lesson_key.isdecimal(): lesson_keys.append(lesson_key)
+                else: logging.warning("Skipping timetable %s %s lesson %r: key is not a lesson number.", group_number, day_name, lesson_key)
+            group_index[day_name] = sorted(lesson_keys, key=int)
+    return index
+
+SORTED_LESSON_KEYS = build_sorted_lesson_keys(timetable_data) # group -> day -> lesson keys in numeric order
 
 if not timetable_data:
-    logging.warning(f"Timetable data ({TIMETABLE_FILE}) not found or invalid. Official schedule features may not work.")
+    logging.warning("Timetable data (%s) not found or invalid. Official schedule features may not work.", TIMETABLE_FILE)
 if not room_links_data:
-    logging.warning(f"Room links data ({ROOM_LINKS_FILE}) not found or invalid. Maps may not be available.")
+    logging.warning("Room links data (%s) not found or invalid. Maps may not be available.", ROOM_LINKS_FILE)
+
+# --- Time Parsing ---
+def is_valid_time_format(time_str):
+    """Checks if a string is in HH:MM format (plain string checks; this runs for every lesson parse)."""
+    return (len(time_str) == 5 and time_str[2] == ':' and time_str.isascii()
+            and time_str[:2].isdigit() and time_str[3:].isdigit()
+            and int(time_str[:2]) < 24 and int(time_str[3:]) < 60)
+
+def parse_start_minute(time_str):
+    """Returns minutes since midnight for the start of an 'HH:MM' or 'HH:MM-HH:MM' string, or None if invalid."""
+    if not time_str or not isinstance(time_str, str):
+        return None
+    return _parse_start_minute_string(time_str)
+
+@functools.lru_cache(maxsize=1024)
+def _parse_start_minute_string(time_str):
+    start_time_str = time_str.split('-')[0].strip()
+    if not is_valid_time_format(start_time_str):
+        return None
+    lesson_hour, lesson_minute = map(int, start_time_str.split(':'))
+    return lesson_hour * 60 + lesson_minute
 
 # --- User Data Persistence ---
-# load_user_data and save_user_data remain unchanged
+CUSTOM_LESSON_FIELDS = ("id", "subject", "day", "start_time", "end_time", "room")
+
+@dataclass(slots=True)
+class CustomLesson:
+    """A user's own weekly lesson. Underscore fields are derived on creation; orjson does not serialize them."""
+    id: str
+    subject: str = "N/A"
+    day: str = "N/A"
+    start_time: str = "N/A"
+    end_time: str = "N/A"
+    room: str = "N/A"
+    _start_min: int = field(init=False, repr=False, compare=False)
+    _sort_key: tuple = field(init=False, repr=False, compare=False) # (weekday, start minute); unknowns sort last
+    _notification_id: str = field(init=False, repr=False, compare=False)
+    _reminder_body: str = field(init=False, repr=False, compare=False) # Reminder text below the per-offset header
+
+    def __post_init__(self):
+        self._start_min = parse_start_minute(self.start_time)
+        self._sort_key = (DAYS_OF_WEEK_INDEX.get(self.day, len(DAYS_OF_WEEK)), self._start_min)
+        self._notification_id = f"custom_{self.id}"
+        self._reminder_body = (f"📌 Subject: <b>{self.subject}</b>\n"
+                               f"🕒 Starts at: {self.start_time} (Ends: {self.end_time})\n"
+                               f"🚪 Room: {self.room}")
+
+    @classmethod
+    def from_dict(cls, data):
+        """Builds a lesson from its stored JSON object, or returns None if it has no usable id, day or times
+        (such a lesson could never fire, so the scheduler relies on none being loaded)."""
+        if not isinstance(data, dict) or not isinstance(data.get("id"), str):
+            return None
+        if not isinstance(data.get("day"), str) or data["day"] not in DAYS_OF_WEEK_INDEX:
+            return None
+        if not all(isinstance(data.get(name), str) and is_valid_time_format(data[name]) for name in ("start_time", "end_time")):
+            return None
+        return cls(**{name: data[name] for name in CUSTOM_LESSON_FIELDS if isinstance(data.get(name), str)})
+
+@dataclass(slots=True)
+class UserRecord:
+    """A registered user's settings. orjson serializes it as a plain JSON object."""
+    group: str | None = None
+    learn_notify: bool = False
+    notification_offset: int = DEFAULT_NOTIFICATION_OFFSET_MINUTES
+    custom_lessons: list[CustomLesson] = field(default_factory=list)
+
 def load_user_data():
     """Loads user data, adding defaults including custom_lessons if necessary."""
     try:
-        with open(USER_DATA_FILE, 'r', encoding='utf-8') as f:
-            raw_data = json.load(f)
+        with open(USER_DATA_FILE, 'rb') as f:
+            raw_data = orjson.loads(f.read())
         processed_data = {}
         for k, v in raw_data.items():
             try:
                 user_id = int(k)
-                default_user_struct = {
-                    "group": None,
-                    "learn_notify": False,
-                    "notification_offset": DEFAULT_NOTIFICATION_OFFSET_MINUTES,
-                    "custom_lessons": []
-                }
                 if isinstance(v, str):
-                    processed_data[user_id] = default_user_struct.copy()
-                    processed_data[user_id]["group"] = v
-                    logging.info(f"Converted user {user_id} data from old string format.")
+                    processed_data[user_id] = UserRecord(group=v)
+                    logging.info("Converted user %s data from old string format.", user_id)
                 elif isinstance(v, dict):
-                    processed_data[user_id] = default_user_struct.copy()
-                    processed_data[user_id].update({
-                        "group": v.get("group"),
-                        "learn_notify": v.get("learn_notify", False),
-                        "notification_offset": v.get("notification_offset", DEFAULT_NOTIFICATION_OFFSET_MINUTES),
-                        "custom_lessons": v.get("custom_lessons", [])
-                    })
-                    if not isinstance(processed_data[user_id]["custom_lessons"], list):
-                         logging.warning(f"Corrected non-list custom_lessons for user {user_id}.")
-                         processed_data[user_id]["custom_lessons"] = []
-                    if len(processed_data[user_id]["custom_lessons"]) > MAX_CUSTOM_LESSONS:
-                        logging.warning(f"User {user_id} had > {MAX_CUSTOM_LESSONS} custom lessons. Truncating.")
-                        processed_data[user_id]["custom_lessons"] = processed_data[user_id]["custom_lessons"][:MAX_CUSTOM_LESSONS]
+                    processed_data[user_id] = UserRecord(
+                        group=v.get("group"),
+                        learn_notify=v.get("learn_notify", False),
+                        notification_offset=v.get("notification_offset", DEFAULT_NOTIFICATION_OFFSET_MINUTES),
+                        custom_lessons=v.get("custom_lessons", [])
+                    )
+                    # Type-check fields here so the scheduler can use them without per-tick defensive checks
+                    if not isinstance(processed_data[user_id].group, (str, type(None))):
+                        logging.warning("Corrected invalid group for user %s.", user_id)
+                        processed_data[user_id].group = None
+                    if not isinstance(processed_data[user_id].learn_notify, bool):
+                        logging.warning("Corrected invalid learn_notify for user %s.", user_id)
+                        processed_data[user_id].learn_notify = False
+                    offset = processed_data[user_id].notification_offset
+                    if isinstance(offset, bool) or not isinstance(offset, int) or not MIN_OFFSET_MINUTES <= offset <= MAX_OFFSET_MINUTES:
+                        logging.warning("Corrected invalid notification_offset %r for user %s.", offset, user_id)
+                        processed_data[user_id].notification_offset = DEFAULT_NOTIFICATION_OFFSET_MINUTES
+                    if not isinstance(processed_data[user_id].custom_lessons, list):
+                         logging.warning("Corrected non-list custom_lessons for user %s.", user_id)
+                         processed_data[user_id].custom_lessons = []
+                    custom_lessons = [CustomLesson.from_dict(lesson) for lesson in processed_data[user_id].custom_lessons]
+                    if None in custom_lessons:
+                        logging.warning("Dropped %s invalid custom lessons for user %s.", custom_lessons.count(None), user_id)
+                        custom_lessons = [lesson for lesson in custom_lessons if lesson is not None]
+                    processed_data[user_id].custom_lessons = custom_lessons
+                    if len(processed_data[user_id].custom_lessons) > MAX_CUSTOM_LESSONS:
+                        logging.warning("User %s had > %s custom lessons. Truncating.", user_id, MAX_CUSTOM_LESSONS)
+                        processed_data[user_id].custom_lessons = processed_data[user_id].custom_lessons[:MAX_CUSTOM_LESSONS]
                 else:
-                    logging.warning(f"Skipping invalid data type for user {user_id}: {type(v)}")
+                    logging.warning("Skipping invalid data type for user %s: %s", user_id, type(v))
             except ValueError:
-                logging.error(f"Skipping invalid user ID key: {k}")
+                logging.error("Skipping invalid user ID key: %s", k)
         return processed_data
-    except (FileNotFoundError, json.JSONDecodeError):
-        logging.warning(f"{USER_DATA_FILE} not found or invalid. Starting with empty user data.")
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        logging.warning("%s not found or invalid. Starting with empty user data.", USER_DATA_FILE)
         return {}
     except Exception as e:
-        logging.error(f"Unexpected error loading user data: {e}", exc_info=True)
+        logging.error("Unexpected error loading user data: %s", e, exc_info=True)
         return {}
 
+user_data_save_lock = threading.Lock() # Held by the worker thread for a whole serialize-and-replace
+
 def save_user_data(data):
     """Saves user data to the JSON file."""
     try:
-        data_to_save = {str(k): v for k, v in data.items()}
-        with open(USER_DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data_to_save, f, indent=4)
+        # Saves run one at a time, each serializing the live dict once it holds the lock. A cancelled flush can
+        # still be running in its worker thread at shutdown; whichever save finishes last has the newest data.
+        with user_data_save_lock:
+            # Serialize in a single orjson call (int keys -> str) so this is safe to run from a worker thread.
+            # Compact output: indentation roughly doubles the bytes rewritten on every flush.
+            data_to_save = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+            # Write to a temp file and swap it in, so a crash mid-write never leaves a truncated user data file.
+            fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(USER_DATA_FILE)), prefix=".user_data_", suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data_to_save)
+                os.replace(tmp_file, USER_DATA_FILE)
+            except BaseException:
+                os.unlink(tmp_file)
+                raise
     except IOError as e:
-        logging.error(f"Error saving user data to {USER_DATA_FILE}: {e}")
+        logging.error("Error saving user data to %s: %s", USER_DATA_FILE, e)
     except Exception as e:
-        logging.error(f"Unexpected error saving user data: {e}", exc_info=True)
+        logging.error("Unexpected error saving user data: %s", e, exc_info=True)
+
+async def save_user_data_async(data):
+    """Saves user data from a worker thread so disk latency never blocks the event loop."""
+    await asyncio.to_thread(save_user_data, data)
+
+async def load_user_data_async():
+    """Loads user data from a worker thread; see save_user_data_async."""
+    return await asyncio.to_thread(load_user_data)
 
 
 # --- Bot Setup ---
@@ -154,38 +327,171 @@ class AddCustomLesson(StatesGroup):
     waiting_for_room = State()
 
 
+# --- Rate Limiting ---
+class RateLimiter:
+    """Token bucket allowing `rate` acquisitions per `period` seconds. Use with `async with`."""
+    def __init__(self, rate, period=1.0):
+        self.rate = rate
+        self.period = period
+        self._tokens = float(rate)
+        self._last_refill = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._last_refill) * self.rate / self.period)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return self
+                await asyncio.sleep((1 - self._tokens) * self.period / self.rate)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+
 # --- Global Data ---
-user_groups: dict[int, dict] = load_user_data()
-notified_lessons = set()
-timetable_usage = {}
-find_usage = {}
+user_groups: dict[int, UserRecord] = load_user_data()
+notified_lessons: dict[str, dict[int, set]] = {} # iso_date -> chat_id -> {notification_id}; past dates are dropped whole
+timetable_usage: OrderedDict[int, float] = OrderedDict() # user_id -> time.monotonic() of last use, oldest first
+find_usage: OrderedDict[int, float] = OrderedDict()
 last_learn_notify_sent_key = None
+user_data_dirty = asyncio.Event() # Set when user_groups changed and needs to be flushed to disk
+schedule_changed = asyncio.Event() # Set when some user's reminders must be re-planned (see reminder_replan_users)
+reminder_replan_users: set[int] = set() # Users whose group, offset or custom lessons changed since the scheduler last ran
+reminder_generations: dict[int, int] = {} # chat_id -> bumped on each re-plan; queued reminders from older generations are skipped
+reminder_seq = itertools.count() # Heap tie-breaker, unique across full rebuilds and per-user re-plans
+global_send_limiter = RateLimiter(GLOBAL_MESSAGES_PER_SECOND) # Shared by all outgoing sends
+send_slots = asyncio.Semaphore(MAX_CONCURRENT_SENDS) # Bounds in-flight requests when a fan-out has thousands of recipients
 # -----------------------------------
 
 # --- Helper Functions ---
+def mark_user_data_dirty():
+    """Schedules user data to be written by the background flush task."""
+    user_data_dirty.set()
+
+def mark_reminders_changed(user_id):
+    """Schedules a re-plan of one user's lesson reminders after their group, offset or custom lessons changed."""
+    reminder_replan_users.add(user_id)
+    schedule_changed.set()
+
+async def flush_user_data_periodically():
+    """Writes user data to disk at most once per USER_DATA_FLUSH_INTERVAL_SECONDS."""
+    while True:
+        await user_data_dirty.wait()
+        user_data_dirty.clear()
+        await save_user_data_async(user_groups)
+        await asyncio.sleep(USER_DATA_FLUSH_INTERVAL_SECONDS)
+
+def is_user_unreachable_error(error):
+    """True if a Telegram error means we can no longer message the chat (bot blocked, user deactivated, chat gone)."""
+    if isinstance(error, (TelegramForbiddenError, TelegramNotFound)):
+        return True
+    if isinstance(error, TelegramBadRequest):
+        error_text = error.message.lower()
+        return any(marker in error_text for marker in UNREACHABLE_CHAT_ERROR_MARKERS)
+    return False
+
+def is_invalid_file_id_error(error):
+    """True if Telegram rejected a stored photo file_id."""
+    if not isinstance(error, TelegramBadRequest):
+        return False
+    error_text = error.message.lower()
+    return any(marker in error_text for marker in INVALID_FILE_ID_ERROR_MARKERS)
+
+def drop_user(user_id):
+    """Forgets a user who can no longer be messaged. Returns True if they were registered."""
+    for day_notified in notified_lessons.values(): day_notified.pop(user_id, None)
+    timetable_usage.pop(user_id, None)
+    find_usage.pop(user_id, None)
+    if user_groups.pop(user_id, None) is None:
+        return False
+    mark_user_data_dirty()
+    return True
+
+def handle_send_error(chat_id, error, context):
+    """Logs a failed send and drops the user if Telegram says they can no longer be messaged."""
+    logging.error("API Error sending %s to %s: %s", context, chat_id, error)
+    if is_user_unreachable_error(error):
+        logging.warning("Removing user %s due to error during %s.", chat_id, context)
+        drop_user(chat_id)
+
+def record_command_usage(usage, user_id, now, cooldown_period):
+    """Records a command use and evicts entries whose cooldown has already expired."""
+    usage[user_id] = now
+    usage.move_to_end(user_id)
+    while usage and now - next(iter(usage.values())) >= cooldown_period:
+        usage.popitem(last=False)
+
+async def send_limited(method, *args, **kwargs):
+    """Calls a Telegram send method under the global rate limiter and in-flight cap, waiting out flood control.
+    Re-raises TelegramRetryAfter if it persists after SEND_MAX_ATTEMPTS attempts."""
+    for attempt in range(1, SEND_MAX_ATTEMPTS + 1):
+        async with send_slots, global_send_limiter:
+            try:
+                return await method(*args, **kwargs)
+            except TelegramRetryAfter as e:
+                if attempt == SEND_MAX_ATTEMPTS: raise
+                retry_after = e.retry_after
+        logging.warning("Flood control on %s (attempt %s). Retrying in %ss.", getattr(method, "__name__", method), attempt, retry_after)
+        await asyncio.sleep(retry_after)
+
+_day_of_week_cache = (None, "") # (epoch minute, day name)
+
 def get_current_day_of_week():
-    now = datetime.now(TIMEZONE)
-    return now.strftime('%A')
+    """Returns today's weekday name in TIMEZONE, recomputed at most once per minute."""
+    global _day_of_week_cache
+    epoch_minute = int(time.time()) // 60
+    if epoch_minute != _day_of_week_cache[0]:
+        _day_of_week_cache = (epoch_minute, datetime.now(TIMEZONE).strftime('%A'))
+    return _day_of_week_cache[1]
 
 def clean_room_number(raw_room):
     """Cleans room number for map lookup. Returns cleaned string or None."""
     if not raw_room or not isinstance(raw_room, str):
         return None
+    return _clean_room_string(raw_room)
+
+@functools.lru_cache(maxsize=4096)
+def _clean_room_string(raw_room):
+    """Cached worker for clean_room_number; room strings come from a small fixed vocabulary."""
     room = raw_room.strip().upper()
     if room == "ONLINE":
         return None
-    room = room.split('(')[0].strip()
-    room = room.split('\n')[0].strip()
-    if len(room) > 1 and room[-1].isalpha():
-        if not room[-2].isalpha():
-             # logging.debug(f"Stripping trailing letter '{room[-1]}' from room '{room}'") # Optional debug
-             room = room[:-1]
-    room = room.strip()
+    room = ROOM_PREFIX_REGEX.match(room).group().strip()
+    if len(room) > 1 and room[-1].isalpha() and not room[-2].isalpha():
+        room = room[:-1].strip()
     return room if room else None
 
-def is_valid_time_format(time_str):
-    """Checks if a string is in HH:MM format."""
-    return bool(TIME_FORMAT_REGEX.match(time_str))
+@functools.lru_cache(maxsize=2048)
+def format_timetable_lesson(group_number, day, lesson_key):
+    """Builds the /timetable text for an official lesson. Timetable rows are static, so results are cached."""
+    lesson_details = timetable_data[group_number][day][lesson_key]
+    room_raw = lesson_details.get("room", "N/A")
+    return TIMETABLE_LESSON_TEMPLATE.format(
+        lesson_key=lesson_key,
+        subject=lesson_details.get("subject", "N/A"),
+        lesson_type=lesson_details.get("type", "N/A").capitalize(),
+        time_range=lesson_details.get("time", "N/A"),
+        lecturer=lesson_details.get("lecturer", "N/A"),
+        room=room_raw if isinstance(room_raw, str) else 'N/A',
+    )
+
+def build_timetable_send(user_id, lesson_info_text, room_raw):
+    """Chooses how to deliver one /timetable lesson. Returns (bot method, kwargs)."""
+    is_online = isinstance(room_raw, str) and room_raw.strip().upper() == "ONLINE"
+    room_cleaned = None if is_online else clean_room_number(room_raw)
+    if is_online:
+        return bot.send_message, {"chat_id": user_id, "text": lesson_info_text}
+    if room_cleaned:
+        photo_file_id = room_links_data.get(room_cleaned)
+        if photo_file_id:
+            return bot.send_photo, {"chat_id": user_id, "photo": photo_file_id, "caption": f"{lesson_info_text}\n\n📍 Location Map ({room_cleaned})"}
+        return bot.send_message, {"chat_id": user_id, "text": f"{lesson_info_text}\n\nℹ️ Map photo for room '{room_cleaned}' is not available."}
+    return bot.send_message, {"chat_id": user_id, "text": f"{lesson_info_text}\n\nℹ️ Room location unknown or map data missing."}
+
 
 # --- Generic Cancel Handler for FSM ---
 @dp.message(Command("cancel"), StateFilter("*"))
@@ -195,7 +501,7 @@ async def cancel_handler(message: types.Message, state: FSMContext):
     if current_state is None:
         await message.reply("Nothing to cancel.")
         return
-    logging.info(f"User {message.from_user.id} cancelled state {current_state}")
+    logging.info("User %s cancelled state %s", message.from_user.id, current_state)
     await state.clear()
     await message.reply("✅ Action cancelled.")
 
@@ -205,7 +511,7 @@ async def cancel_handler(message: types.Message, state: FSMContext):
 
 @dp.message(CommandStart())
 async def send_welcome(message: types.Message, state: FSMContext):
-    logging.info(f"User {message.from_user.id} started the bot.")
+    logging.info("User %s started the bot.", message.from_user.id)
     await state.clear()
     await message.reply("Welcome! 👋 Please enter your group number (e.g., EE-2401 or IoT-2401) to get started, or use /help.")
     await state.set_state(Registration.waiting_for_group)
@@ -213,141 +519,97 @@ async def send_welcome(message: types.Message, state: FSMContext):
 @dp.message(Registration.waiting_for_group, F.text)
 async def process_group_number(message: types.Message, state: FSMContext):
     user_input = message.text.strip()
-    matched_group_key = None
-    if timetable_data:
-        for key in timetable_data.keys():
-            if key.upper() == user_input.upper():
-                matched_group_key = key
-                break
+    matched_group_key = GROUP_KEY_INDEX.get(user_input.upper())
     user_id = message.from_user.id
     if matched_group_key:
-        existing_data = user_groups.get(user_id, {})
-        user_groups[user_id] = {
-            "group": matched_group_key,
-            "learn_notify": existing_data.get("learn_notify", False),
-            "notification_offset": existing_data.get("notification_offset", DEFAULT_NOTIFICATION_OFFSET_MINUTES),
-            "custom_lessons": existing_data.get("custom_lessons", [])
-        }
-        save_user_data(user_groups)
-        current_offset = user_groups[user_id]["notification_offset"]
+        user_data = user_groups.get(user_id)
+        if user_data is None: user_data = user_groups[user_id] = UserRecord()
+        user_data.group = matched_group_key # Re-registration keeps offset, Learn setting and custom lessons
+        mark_user_data_dirty()
+        mark_reminders_changed(user_id)
+        current_offset = user_data.notification_offset
         await message.reply(f"✅ Great! Your group '{matched_group_key}' is registered. "
                           f"I will notify you <b>{current_offset} minutes</b> before your lessons.\n"
                           f"Use /timetable for today's official schedule.\n"
                           f"Use /add_lesson to add your own reminders.\n"
                           f"See all commands with /help.")
-        logging.info(f"User {user_id} registered/updated group: {matched_group_key}, offset: {current_offset}")
+        logging.info("User %s registered/updated group: %s, offset: %s", user_id, matched_group_key, current_offset)
         await state.clear()
     else:
-        existing_data = user_groups.get(user_id, {})
+        existing_data = user_groups.get(user_id)
         if not existing_data:
-             user_groups[user_id] = {
-                "group": None, "learn_notify": False,
-                "notification_offset": DEFAULT_NOTIFICATION_OFFSET_MINUTES,
-                "custom_lessons": []
-             }
-             save_user_data(user_groups)
+             user_groups[user_id] = UserRecord()
+             mark_user_data_dirty()
              await message.reply(f"⚠️ Couldn't find group '{user_input}' in the official timetable. "
                                 f"I've registered you, but official schedule features won't work.\n"
                                 f"You can still use /add_lesson for custom reminders.\n"
                                 f"If '{user_input}' was a typo, use /start again.\n"
                                 f"See commands with /help.")
-             logging.warning(f"User {message.from_user.id} entered group '{user_input}' (not found). Registered without official group.")
+             logging.warning("User %s entered group '%s' (not found). Registered without official group.", message.from_user.id, user_input)
              await state.clear()
         else:
              await message.reply("❌ Sorry, I couldn't find that group number in the timetable. "
                                  "Please check the format (e.g., EE-2401) and try again, or use /cancel.")
-             logging.warning(f"User {message.from_user.id} entered group '{user_input}', which was not found. User already existed.")
+             logging.warning("User %s entered group '%s', which was not found. User already existed.", message.from_user.id, user_input)
 
 @dp.message(Command("timetable"))
 async def show_daily_timetable(message: types.Message):
     user_id = message.from_user.id
-    current_time = time.time()
+    current_time = time.monotonic()
     cooldown_period = 30
-    last_used = timetable_usage.get(user_id, 0)
-    if current_time - last_used < cooldown_period:
+    last_used = timetable_usage.get(user_id)
+    if last_used is not None and current_time - last_used < cooldown_period:
         time_remaining = int(cooldown_period - (current_time - last_used))
         await message.reply(f"⏳ Please wait {time_remaining}s before using /timetable again.")
-        logging.warning(f"User {user_id} triggered /timetable cooldown ({time_remaining:.1f}s remaining).")
+        logging.warning("User %s triggered /timetable cooldown (%.1fs remaining).", user_id, time_remaining)
         return
     user_data = user_groups.get(user_id)
     if not user_data:
         await message.reply("I don't know you yet. Please use /start to register.")
         return
-    if not user_data.get("group"):
+    if not user_data.group:
         await message.reply("Your group isn't set or wasn't found in the official schedule. Use /start to set it, or /view_lessons for your custom schedule.")
         return
     if not timetable_data:
          await message.reply("The official timetable data is currently unavailable. Please try again later.")
          return
-    group_number = user_data["group"]
+    group_number = user_data.group
     current_day = get_current_day_of_week()
-    logging.info(f"User {user_id} ({group_number}) requested timetable for {current_day}.")
-    group_schedule = timetable_data.get(group_number, {})
-    day_schedule = group_schedule.get(current_day)
-    timetable_usage[user_id] = current_time
+    logging.info("User %s (%s) requested timetable for %s.", user_id, group_number, current_day)
+    sorted_lesson_keys = SORTED_LESSON_KEYS.get(group_number, {}).get(current_day) # None if the day is missing or malformed
+    day_schedule = timetable_data[group_number][current_day] if sorted_lesson_keys is not None else None
+    record_command_usage(timetable_usage, user_id, current_time, cooldown_period)
     if not day_schedule:
         await message.reply(f"🎉 No official lessons scheduled for your group ({group_number}) today ({current_day})! Check /view_lessons for custom ones.")
-        logging.info(f"No official lessons found for {user_id} ({group_number}) on {current_day}.")
+        logging.info("No official lessons found for %s (%s) on %s.", user_id, group_number, current_day)
         return
     await message.reply(f"📅 <b>Official Timetable for {current_day} ({group_number}):</b>")
-    sorted_lesson_keys = sorted(day_schedule.keys(), key=int)
     sent_lesson = False
     for lesson_key in sorted_lesson_keys:
         try:
-            lesson_details = day_schedule[lesson_key]
-            time_range = lesson_details.get("time", "N/A")
-            subject = lesson_details.get("subject", "N/A")
-            room_raw = lesson_details.get("room", "N/A")
-            lesson_type = lesson_details.get("type", "N/A").capitalize()
-            lecturer = lesson_details.get("lecturer", "N/A")
-            lesson_info_text = (
-                f"<b>{lesson_key}. {subject}</b> ({lesson_type})\n"
-                f"🕒 Time: {time_range}\n"
-                f"👨‍🏫 Lecturer: {lecturer}\n"
-                f"🚪 Room: {room_raw if isinstance(room_raw, str) else 'N/A'}"
-            )
-            is_online = isinstance(room_raw, str) and room_raw.strip().upper() == "ONLINE"
-            room_cleaned = None
-            if not is_online:
-                room_cleaned = clean_room_number(room_raw)
-            if is_online:
-                await bot.send_message(chat_id=user_id, text=lesson_info_text)
-            elif room_cleaned and room_links_data:
-                photo_file_id = room_links_data.get(room_cleaned)
-                if photo_file_id:
-                    caption_text = f"{lesson_info_text}\n\n📍 Location Map ({room_cleaned})"
-                    try:
-                        await bot.send_photo(chat_id=user_id, photo=photo_file_id, caption=caption_text)
-                    except TelegramAPIError as e_photo:
-                        logging.error(f"Timetable: Failed to send photo {photo_file_id} for room {room_cleaned} (raw: {room_raw}) to {user_id}: {e_photo}")
-                        fallback_text = f"{lesson_info_text}\n\n⚠️ Couldn't send map photo ({e_photo})."
-                        await bot.send_message(user_id, fallback_text)
-                        if "blocked" in str(e_photo).lower() or "deactivated" in str(e_photo).lower(): raise e_photo
-                else:
-                    text_with_note = f"{lesson_info_text}\n\nℹ️ Map photo for room '{room_cleaned}' is not available."
-                    await bot.send_message(chat_id=user_id, text=text_with_note)
-            else:
-                 text_with_note = f"{lesson_info_text}\n\nℹ️ Room location unknown or map data missing."
-                 await bot.send_message(chat_id=user_id, text=text_with_note)
+            room_raw = day_schedule[lesson_key].get("room", "N/A")
+            lesson_info_text = format_timetable_lesson(group_number, current_day, lesson_key)
+            method, send_kwargs = build_timetable_send(user_id, lesson_info_text, room_raw)
+            try:
+                await send_limited(method, **send_kwargs)
+            except TelegramAPIError as e_photo:
+                if "photo" not in send_kwargs: raise
+                logging.error("Timetable: Failed to send photo %s (room raw: %s) to %s: %s", send_kwargs["photo"], room_raw, user_id, e_photo)
+                fallback_text = f"{lesson_info_text}\n\n⚠️ Couldn't send map photo ({e_photo})."
+                await send_limited(bot.send_message, user_id, fallback_text)
+                if is_user_unreachable_error(e_photo): raise e_photo
             sent_lesson = True
-            await asyncio.sleep(RATE_LIMIT_DELAY)
         except TelegramAPIError as e:
-            logging.error(f"Telegram API Error processing lesson {lesson_key} for {user_id}: {e}")
-            if "blocked" in str(e).lower() or "deactivated" in str(e).lower() or "user is deactivated" in str(e).lower() or "chat not found" in str(e).lower():
-                logging.warning(f"User {user_id} blocked/deactivated during timetable request. Removing.")
-                if user_groups.pop(user_id, None) is not None:
-                    global notified_lessons
-                    notified_lessons = {n for n in notified_lessons if n[0] != user_id}
-                    save_user_data(user_groups)
-                timetable_usage.pop(user_id, None)
-                find_usage.pop(user_id, None)
+            logging.error("Telegram API Error processing lesson %s for %s: %s", lesson_key, user_id, e)
+            if is_user_unreachable_error(e):
+                logging.warning("User %s blocked/deactivated during timetable request. Removing.", user_id)
+                drop_user(user_id)
                 break
             else:
-                 logging.warning(f"Continuing timetable processing for {user_id} despite non-blocking API error: {e}")
-                 await asyncio.sleep(1)
+                 logging.warning("Continuing timetable processing for %s despite non-blocking API error: %s", user_id, e)
         except Exception as e:
-            logging.error(f"Unexpected error processing lesson {lesson_key} for {user_id}: {e}", exc_info=True)
-            try: await bot.send_message(user_id, "An error occurred while fetching part of the timetable.")
+            logging.error("Unexpected error processing lesson %s for %s: %s", lesson_key, user_id, e, exc_info=True)
+            try: await send_limited(bot.send_message, user_id, "An error occurred while fetching part of the timetable.")
             except Exception: pass
             break
     if not sent_lesson and not day_schedule:
@@ -356,62 +618,67 @@ async def show_daily_timetable(message: types.Message):
 @dp.message(Command("find"))
 async def handle_find_room(message: types.Message):
     user_id = message.from_user.id
-    current_time = time.time()
+    current_time = time.monotonic()
     cooldown_period = 10
-    last_used = find_usage.get(user_id, 0)
-    if current_time - last_used < cooldown_period:
+    last_used = find_usage.get(user_id)
+    if last_used is not None and current_time - last_used < cooldown_period:
         time_remaining = int(cooldown_period - (current_time - last_used))
         await message.reply(f"⏳ Please wait {time_remaining}s before using /find again.")
-        logging.warning(f"User {user_id} triggered /find cooldown ({time_remaining:.1f}s remaining).")
+        logging.warning("User %s triggered /find cooldown (%.1fs remaining).", user_id, time_remaining)
         return
     command_parts = message.text.split(maxsplit=1)
     if len(command_parts) < 2 or not command_parts[1].strip():
         await message.reply("❓ Please specify the room number after the command.\nExample: <code>/find C1.3.122</code> or <code>/find C1.1.256P</code>")
         return
     room_query = command_parts[1].strip()
-    logging.info(f"User {user_id} requested to find room: '{room_query}'")
+    if len(room_query) > MAX_ROOM_INPUT_LENGTH or not room_query.isascii():
+        await message.reply("❌ That doesn't look like a room number. Example: <code>/find C1.3.122</code>")
+        logging.warning("Rejected /find query from %s before lookup (too long or non-ASCII).", user_id)
+        return
+    logging.info("User %s requested to find room: '%s'", user_id, room_query)
     room_cleaned = clean_room_number(room_query)
     if not room_cleaned:
         await message.reply(f"❌ Sorry, '{room_query}' doesn't look like a valid physical room number I can search for (after cleaning).")
-        logging.warning(f"Invalid room format provided by {user_id} for /find: '{room_query}' -> cleaned to None")
+        logging.warning("Invalid room format provided by %s for /find: '%s' -> cleaned to None", user_id, room_query)
         return
     if not room_links_data:
          await message.reply("Room map data is currently unavailable.")
          return
-    find_usage[user_id] = current_time
+    record_command_usage(find_usage, user_id, current_time, cooldown_period)
     photo_file_id = room_links_data.get(room_cleaned)
     if photo_file_id:
-        logging.info(f"Found map for room '{room_cleaned}' (cleaned from '{room_query}') for user {user_id}. Sending photo.")
+        logging.info("Found map for room '%s' (cleaned from '%s') for user %s. Sending photo.", room_cleaned, room_query, user_id)
         try:
-            await bot.send_photo(chat_id=user_id, photo=photo_file_id, caption=f"📍 Location map for room {room_cleaned}")
+            await send_limited(bot.send_photo, chat_id=user_id, photo=photo_file_id, caption=f"📍 Location map for room {room_cleaned}")
         except TelegramAPIError as e:
-            logging.error(f"Failed to send photo {photo_file_id} for room '{room_cleaned}' to {user_id} via /find: {e}")
-            if "FILE_ID_INVALID" in str(e).upper() or "invalid file identifier" in str(e): await message.reply(f"ℹ️ The map data for room '{room_cleaned}' seems to be invalid or corrupted.")
-            elif "blocked" in str(e).lower() or "deactivated" in str(e).lower():
-                 logging.warning(f"User {user_id} blocked bot during /find request. Removing from active usage tracking.")
+            logging.error("Failed to send photo %s for room '%s' to %s via /find: %s", photo_file_id, room_cleaned, user_id, e)
+            if is_invalid_file_id_error(e): await message.reply(f"ℹ️ The map data for room '{room_cleaned}' seems to be invalid or corrupted.")
+            elif is_user_unreachable_error(e):
+                 logging.warning("User %s blocked bot during /find request. Removing from active usage tracking.", user_id)
                  timetable_usage.pop(user_id, None)
                  find_usage.pop(user_id, None)
             else: await message.reply(f"❌ An error occurred while sending the map for '{room_cleaned}'.")
         except Exception as e:
-            logging.error(f"Unexpected error sending photo for room '{room_cleaned}' to {user_id} via /find: {e}", exc_info=True)
+            logging.error("Unexpected error sending photo for room '%s' to %s via /find: %s", room_cleaned, user_id, e, exc_info=True)
             await message.reply("An unexpected error occurred while sending the map.")
     else:
-        logging.warning(f"Map not found for cleaned room '{room_cleaned}' (query: '{room_query}') requested by {user_id}.")
+        logging.warning("Map not found for cleaned room '%s' (query: '%s') requested by %s.", room_cleaned, room_query, user_id)
         await message.reply(f"❌ Sorry, I couldn't find a map for room '{room_cleaned}'. Check the room number or it might not be in my database.")
 
 @dp.message(Command("minutes"))
 async def handle_minutes_command(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    if user_id not in user_groups:
+    user_data = user_groups.get(user_id)
+    if user_data is None:
         await message.reply("I need to know you first. Please use /start to register.")
         return
-    current_offset = user_groups[user_id].get("notification_offset", DEFAULT_NOTIFICATION_OFFSET_MINUTES)
+    current_offset = user_data.notification_offset
     await message.reply(
         f"Your current notification offset is <b>{current_offset} minutes</b> before the lesson.\n\n"
         f"Please enter the new number of minutes you want (from {MIN_OFFSET_MINUTES} to {MAX_OFFSET_MINUTES}), or /cancel:"
     )
     await state.set_state(NotificationSettings.waiting_for_minutes)
-    logging.info(f"User {user_id} initiated /minutes command. Current offset: {current_offset}")
+    logging.info("User %s initiated /minutes command. Current offset: %s", user_id, current_offset)
 
 @dp.message(NotificationSettings.waiting_for_minutes, F.text)
 async def process_minutes_input(message: types.Message, state: FSMContext):
@@ -419,90 +686,93 @@ async def process_minutes_input(message: types.Message, state: FSMContext):
     try:
         minutes_input = int(message.text.strip())
         if MIN_OFFSET_MINUTES <= minutes_input <= MAX_OFFSET_MINUTES:
-            if user_id in user_groups:
-                user_groups[user_id]["notification_offset"] = minutes_input
-                save_user_data(user_groups)
+            user_data = user_groups.get(user_id)
+            if user_data is not None:
+                user_data.notification_offset = minutes_input
+                mark_user_data_dirty()
+                mark_reminders_changed(user_id)
                 await message.reply(f"✅ Okay! Your notification offset has been updated to <b>{minutes_input} minutes</b> before each lesson.")
-                logging.info(f"User {user_id} successfully set notification offset to {minutes_input} minutes.")
+                logging.info("User %s successfully set notification offset to %s minutes.", user_id, minutes_input)
                 await state.clear()
             else:
                 await message.reply("Something went wrong, couldn't find your user data. Please try /start again.")
-                logging.error(f"User {user_id} was in state waiting_for_minutes, but user_data was missing.")
+                logging.error("User %s was in state waiting_for_minutes, but user_data was missing.", user_id)
                 await state.clear()
         else:
             await message.reply(f"❌ Invalid number. Please enter a value between {MIN_OFFSET_MINUTES} and {MAX_OFFSET_MINUTES}, or /cancel.")
-            logging.warning(f"User {user_id} entered invalid offset: {minutes_input}. Prompting again.")
+            logging.warning("User %s entered invalid offset: %s. Prompting again.", user_id, minutes_input)
     except ValueError:
         await message.reply(f"❌ That doesn't look like a valid number. Please enter a whole number between {MIN_OFFSET_MINUTES} and {MAX_OFFSET_MINUTES}, or /cancel.")
-        logging.warning(f"User {user_id} entered non-numeric value for offset: '{message.text}'. Prompting again.")
+        logging.warning("User %s entered non-numeric value for offset: '%s'. Prompting again.", user_id, message.text)
     except Exception as e:
-        logging.error(f"Error processing minutes input for user {user_id}: {e}", exc_info=True)
+        logging.error("Error processing minutes input for user %s: %s", user_id, e, exc_info=True)
         await message.reply("An unexpected error occurred. Please try again later or use /cancel.")
         await state.clear()
 
 @dp.message(Command("learn"))
 async def handle_learn_command(message: types.Message):
     user_id = message.from_user.id
-    if user_id not in user_groups:
+    user_data = user_groups.get(user_id)
+    if user_data is None:
         await message.reply("I need to know you first. Please use /start to register.")
         return
-    current_state = user_groups[user_id].get("learn_notify", False)
-    new_state = not current_state
-    user_groups[user_id]["learn_notify"] = new_state
-    save_user_data(user_groups)
+    new_state = not user_data.learn_notify
+    user_data.learn_notify = new_state
+    mark_user_data_dirty()
     status_message = "ON" if new_state else "OFF"
     await message.reply(f"✅ Learn platform notifications turned {status_message}.")
-    logging.info(f"User {user_id} toggled learn notifications to {status_message}.")
+    logging.info("User %s toggled learn notifications to %s.", user_id, status_message)
 
 @dp.message(Command("broadcast"))
 async def start_broadcast(message: types.Message, state: FSMContext):
-    # Admin check and broadcast logic remains unchanged
     if message.from_user.id != ADMIN_ID: return
     await state.clear()
     await message.reply("Okay, Admin! Send me the message you want to broadcast, or /cancel.")
     await state.set_state(Broadcasting.waiting_for_message)
-    logging.info(f"Admin {ADMIN_ID} initiated broadcast sequence.")
+    logging.info("Admin %s initiated broadcast sequence.", ADMIN_ID)
 
 @dp.message(Broadcasting.waiting_for_message, F.from_user.id == ADMIN_ID)
 async def handle_broadcast_content(message: types.Message, state: FSMContext):
-    # Admin check and broadcast logic remains unchanged
     await state.clear()
     if not user_groups:
         await message.reply("No registered users to broadcast to.")
         return
-    logging.info(f"Admin {ADMIN_ID} provided broadcast content. Starting broadcast.")
+    logging.info("Admin %s provided broadcast content. Starting broadcast.", ADMIN_ID)
     await message.reply(f"Starting broadcast to {len(user_groups)} users...")
     success_count, fail_count, blocked_users = 0, 0, []
-    users_to_broadcast = list(user_groups.keys()) # Copy keys
-    for chat_id in users_to_broadcast:
-        if chat_id not in user_groups: continue
+    users_to_broadcast = list(user_groups) # Snapshot taken once; blocked users are dropped after all sends finish
+    if message.content_type == ContentType.TEXT:
+        # Plain text is re-sent as HTML (the bot's default parse mode) instead of making Telegram resolve a copy per user
+        broadcast_text = message.html_text
+        async def send_broadcast(chat_id):
+            return await bot.send_message(chat_id=chat_id, text=broadcast_text)
+    else:
+        send_broadcast = message.copy_to
+
+    async def send_one(chat_id):
+        nonlocal success_count, fail_count
         try:
-            await message.copy_to(chat_id=chat_id)
+            await send_limited(send_broadcast, chat_id=chat_id)
             success_count += 1
+        except TelegramRetryAfter as e:
+            fail_count += 1
+            logging.error("Failed broadcast to %s: still rate limited after %s attempts (%s).", chat_id, SEND_MAX_ATTEMPTS, e)
         except TelegramAPIError as e:
             fail_count += 1
-            logging.error(f"Failed broadcast to {chat_id}: {e}")
-            if "blocked" in str(e).lower() or "deactivated" in str(e).lower() or "chat not found" in str(e).lower() or "user is deactivated" in str(e).lower():
+            logging.error("Failed broadcast to %s: %s", chat_id, e)
+            if is_user_unreachable_error(e):
                 blocked_users.append(chat_id)
         except Exception as e:
             fail_count += 1
-            logging.error(f"Unexpected broadcast error to {chat_id}: {e}")
-        await asyncio.sleep(BROADCAST_RATE_LIMIT_DELAY)
-    if blocked_users:
-        updated = False
-        for user_id in blocked_users:
-            if user_groups.pop(user_id, None) is not None:
-                updated = True
-                logging.info(f"Removed blocked user {user_id} after broadcast attempt.")
-                global notified_lessons
-                notified_lessons = {n for n in notified_lessons if n[0] != user_id}
-                timetable_usage.pop(user_id, None)
-                find_usage.pop(user_id, None)
-        if updated: save_user_data(user_groups)
+            logging.error("Unexpected broadcast error to %s: %s", chat_id, e)
+
+    await asyncio.gather(*(send_one(chat_id) for chat_id in users_to_broadcast))
+    removed_count = sum(drop_user(user_id) for user_id in blocked_users) # One pass; flushed by a single save
+    if removed_count: logging.info("Removed %s blocked/deactivated users after broadcast: %s", removed_count, blocked_users)
     summary = f"Broadcast finished.\nSuccess: {success_count}\nFailed: {fail_count}"
-    if blocked_users: summary += f"\nRemoved {len(blocked_users)} blocked/deactivated users."
+    if removed_count: summary += f"\nRemoved {removed_count} blocked/deactivated users."
     await message.reply(summary)
-    logging.info(f"Broadcast summary: {summary}")
+    logging.info("Broadcast summary: %s", summary)
 
 @dp.message(Command("help"))
 async def send_help_message(message: types.Message):
@@ -531,17 +801,16 @@ async def send_help_message(message: types.Message):
 @dp.message(Command("add_lesson"))
 async def add_custom_lesson_start(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    if user_id not in user_groups:
+    user_data = user_groups.get(user_id)
+    if user_data is None:
         await message.reply("Please register using /start before adding custom lessons.")
         return
-    if len(user_groups[user_id].get("custom_lessons", [])) >= MAX_CUSTOM_LESSONS:
+    if len(user_data.custom_lessons) >= MAX_CUSTOM_LESSONS:
         await message.reply(f"❌ You have reached the maximum limit of {MAX_CUSTOM_LESSONS} custom lessons. Use /delete_lesson to remove old ones first.")
         return
-    buttons = [ [InlineKeyboardButton(text=day, callback_data=f"add_day_{day}")] for day in DAYS_OF_WEEK ]
-    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-    await message.reply("Let's add a custom lesson. First, select the day of the week:", reply_markup=keyboard)
+    await message.reply("Let's add a custom lesson. First, select the day of the week:", reply_markup=DAY_KEYBOARD)
     await state.set_state(AddCustomLesson.waiting_for_day)
-    logging.info(f"User {user_id} initiated /add_lesson.")
+    logging.info("User %s initiated /add_lesson.", user_id)
 
 @dp.callback_query(AddCustomLesson.waiting_for_day, F.data.startswith("add_day_"))
 async def process_custom_lesson_day(callback_query: CallbackQuery, state: FSMContext):
@@ -551,7 +820,7 @@ async def process_custom_lesson_day(callback_query: CallbackQuery, state: FSMCon
                                            f"Now, please enter a name or subject for this lesson (e.g., 'Study Group', 'AI Club Meeting'), or /cancel:")
     await callback_query.answer()
     await state.set_state(AddCustomLesson.waiting_for_subject)
-    logging.info(f"User {callback_query.from_user.id} selected day '{selected_day}' for custom lesson.")
+    logging.info("User %s selected day '%s' for custom lesson.", callback_query.from_user.id, selected_day)
 
 @dp.message(AddCustomLesson.waiting_for_subject, F.text)
 async def process_custom_lesson_subject(message: types.Message, state: FSMContext):
@@ -566,7 +835,7 @@ async def process_custom_lesson_subject(message: types.Message, state: FSMContex
     await message.reply(f"✅ Subject set to: <b>{subject}</b>.\n\n"
                       f"Now, enter the <b>start time</b> in HH:MM format (e.g., 09:00, 14:30), or /cancel:")
     await state.set_state(AddCustomLesson.waiting_for_start_time)
-    logging.info(f"User {message.from_user.id} entered subject '{subject}' for custom lesson.")
+    logging.info("User %s entered subject '%s' for custom lesson.", message.from_user.id, subject)
 
 @dp.message(AddCustomLesson.waiting_for_start_time, F.text)
 async def process_custom_lesson_start_time(message: types.Message, state: FSMContext):
@@ -578,7 +847,7 @@ async def process_custom_lesson_start_time(message: types.Message, state: FSMCon
     await message.reply(f"✅ Start time set to: <b>{start_time}</b>.\n\n"
                       f"Now, enter the <b>end time</b> in HH:MM format (e.g., 10:30, 16:00), or /cancel:")
     await state.set_state(AddCustomLesson.waiting_for_end_time)
-    logging.info(f"User {message.from_user.id} entered start time '{start_time}' for custom lesson.")
+    logging.info("User %s entered start time '%s' for custom lesson.", message.from_user.id, start_time)
 
 @dp.message(AddCustomLesson.waiting_for_end_time, F.text)
 async def process_custom_lesson_end_time(message: types.Message, state: FSMContext):
@@ -596,13 +865,13 @@ async def process_custom_lesson_end_time(message: types.Message, state: FSMConte
             return
     except ValueError:
         await message.reply("Error comparing times. Please try again or /cancel.")
-        logging.error(f"Error comparing times {start_time} and {end_time} for user {message.from_user.id}")
+        logging.error("Error comparing times %s and %s for user %s", start_time, end_time, message.from_user.id)
         return
     await state.update_data(end_time=end_time)
     await message.reply(f"✅ End time set to: <b>{end_time}</b>.\n\n"
                       f"Finally, enter the <b>room number</b> (e.g., C1.3.122 or C1.1.256P) (if it is Physical Education type anything, e.g. <b>Gym</b>), or type 'ONLINE', or /cancel:")
     await state.set_state(AddCustomLesson.waiting_for_room)
-    logging.info(f"User {message.from_user.id} entered end time '{end_time}' for custom lesson.")
+    logging.info("User %s entered end time '%s' for custom lesson.", message.from_user.id, end_time)
 
 @dp.message(AddCustomLesson.waiting_for_room, F.text)
 async def process_custom_lesson_room(message: types.Message, state: FSMContext):
@@ -611,6 +880,9 @@ async def process_custom_lesson_room(message: types.Message, state: FSMContext):
     if not room_input:
         await message.reply("Room cannot be empty. Please enter a room number (e.g., C1.3.122) or 'ONLINE', or /cancel.")
         return
+    if len(room_input) > MAX_ROOM_INPUT_LENGTH:
+        await message.reply(f"Room is too long (max {MAX_ROOM_INPUT_LENGTH} chars). Please enter a shorter room, or /cancel.")
+        return
     room_to_store = room_input
     room_cleaned_for_lookup = None
     is_online = False
@@ -626,75 +898,72 @@ async def process_custom_lesson_room(message: types.Message, state: FSMContext):
             await message.reply(f"⚠️ Room '{room_input}' entered. I will look for a map for '{room_cleaned_for_lookup}', but I don't seem to have one. "
                                 f"The lesson will be saved, but map notifications might not work. You can continue or /cancel.")
     lesson_data = await state.get_data()
-    lesson_data['room'] = room_to_store
-    lesson_data['id'] = str(uuid.uuid4())
-    if user_id in user_groups:
-        if len(user_groups[user_id].get("custom_lessons", [])) < MAX_CUSTOM_LESSONS:
-            user_groups[user_id].setdefault("custom_lessons", []).append(lesson_data)
-            save_user_data(user_groups)
+    lesson = CustomLesson(id=str(uuid.uuid4()), subject=lesson_data['subject'], day=lesson_data['day'],
+                          start_time=lesson_data['start_time'], end_time=lesson_data['end_time'], room=room_to_store)
+    user_data = user_groups.get(user_id)
+    if user_data is not None:
+        if len(user_data.custom_lessons) < MAX_CUSTOM_LESSONS:
+            user_data.custom_lessons.append(lesson)
+            mark_user_data_dirty()
+            mark_reminders_changed(user_id)
             await message.reply(
                 f"✅ <b>Custom lesson added!</b>\n\n"
-                f"📌 Subject: {lesson_data['subject']}\n"
-                f"📅 Day: {lesson_data['day']}\n"
-                f"🕒 Time: {lesson_data['start_time']} - {lesson_data['end_time']}\n"
-                f"🚪 Room: {lesson_data['room']} "
+                f"📌 Subject: {lesson.subject}\n"
+                f"📅 Day: {lesson.day}\n"
+                f"🕒 Time: {lesson.start_time} - {lesson.end_time}\n"
+                f"🚪 Room: {lesson.room} "
                 f"{f'(Map lookup: {room_cleaned_for_lookup})' if not is_online and room_cleaned_for_lookup else ''}\n\n"
                 f"Use /view_lessons to see all your custom lessons."
             )
-            logging.info(f"User {user_id} successfully added custom lesson: {lesson_data}")
+            logging.info("User %s successfully added custom lesson: %s", user_id, lesson)
             await state.clear()
         else:
             await message.reply(f"❌ Could not save. You have reached the maximum limit of {MAX_CUSTOM_LESSONS} custom lessons.")
-            logging.warning(f"User {user_id} reached max custom lessons during final save step.")
+            logging.warning("User %s reached max custom lessons during final save step.", user_id)
             await state.clear()
     else:
         await message.reply("Error: Could not find your user data. Please try /start again.")
-        logging.error(f"User {user_id} was in state waiting_for_room, but user_data was missing during save.")
+        logging.error("User %s was in state waiting_for_room, but user_data was missing during save.", user_id)
         await state.clear()
 
 @dp.message(Command("view_lessons"))
 async def view_custom_lessons(message: types.Message):
     user_id = message.from_user.id
-    if user_id not in user_groups or not user_groups[user_id].get("custom_lessons"):
+    user_data = user_groups.get(user_id)
+    custom_lessons = user_data.custom_lessons if user_data else None
+    if not custom_lessons:
         await message.reply("You haven't added any custom lessons yet. Use /add_lesson to create one.")
         return
-    custom_lessons = user_groups[user_id]["custom_lessons"]
-    response_text = "📅 <b>Your Custom Lessons:</b>\n\n"
-    if not custom_lessons:
-         await message.reply("You haven't added any custom lessons yet. Use /add_lesson to create one.")
-         return
-    lessons_sorted = sorted(custom_lessons, key=lambda x: (DAYS_OF_WEEK.index(x.get('day', 'Sunday')), x.get('start_time', '23:59')))
+    parts = ["📅 <b>Your Custom Lessons:</b>\n\n"]
+    lessons_sorted = sorted(custom_lessons, key=lambda lesson: lesson._sort_key)
     for i, lesson in enumerate(lessons_sorted):
-        room_display = lesson.get('room', 'N/A')
-        response_text += (
-            f"<b>{i+1}. {lesson.get('subject', 'N/A')}</b>\n"
-            f"   - Day: {lesson.get('day', 'N/A')}\n"
-            f"   - Time: {lesson.get('start_time', 'N/A')} - {lesson.get('end_time', 'N/A')}\n"
-            f"   - Room: {room_display}\n\n"
+        parts.append(
+            f"<b>{i+1}. {lesson.subject}</b>\n"
+            f"   - Day: {lesson.day}\n"
+            f"   - Time: {lesson.start_time} - {lesson.end_time}\n"
+            f"   - Room: {lesson.room}\n\n"
         )
-    response_text += "Use /delete_lesson to remove lessons."
-    await message.reply(response_text)
-    logging.info(f"User {user_id} viewed their {len(custom_lessons)} custom lessons.")
+    parts.append("Use /delete_lesson to remove lessons.")
+    await message.reply("".join(parts))
+    logging.info("User %s viewed their %s custom lessons.", user_id, len(custom_lessons))
 
 @dp.message(Command("delete_lesson"))
 async def delete_custom_lesson_start(message: types.Message):
     user_id = message.from_user.id
-    if user_id not in user_groups or not user_groups[user_id].get("custom_lessons"):
-        await message.reply("You don't have any custom lessons to delete. Use /add_lesson first.")
-        return
-    custom_lessons = user_groups[user_id]["custom_lessons"]
+    user_data = user_groups.get(user_id)
+    custom_lessons = user_data.custom_lessons if user_data else None
     if not custom_lessons:
         await message.reply("You don't have any custom lessons to delete. Use /add_lesson first.")
         return
     buttons = []
-    lessons_sorted = sorted(custom_lessons, key=lambda x: (DAYS_OF_WEEK.index(x.get('day', 'Sunday')), x.get('start_time', '23:59')))
+    lessons_sorted = sorted(custom_lessons, key=lambda lesson: lesson._sort_key)
     for lesson in lessons_sorted:
-        label = f"{lesson.get('day', '?')[:3]} {lesson.get('start_time', '?:??')} - {lesson.get('subject', 'N/A')[:20]}"
-        buttons.append([InlineKeyboardButton(text=label, callback_data=f"delete_lesson_{lesson.get('id')}")])
+        label = f"{lesson.day[:3]} {lesson.start_time} - {lesson.subject[:20]}"
+        buttons.append([InlineKeyboardButton(text=label, callback_data=f"delete_lesson_{lesson.id}")])
     buttons.append([InlineKeyboardButton(text="❌ Cancel Deletion", callback_data="delete_lesson_cancel")])
     keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
     await message.reply("Select the custom lesson you want to delete:", reply_markup=keyboard)
-    logging.info(f"User {user_id} initiated /delete_lesson.")
+    logging.info("User %s initiated /delete_lesson.", user_id)
 
 @dp.callback_query(F.data.startswith("delete_lesson_"))
 async def process_custom_lesson_delete(callback_query: CallbackQuery):
@@ -703,27 +972,29 @@ async def process_custom_lesson_delete(callback_query: CallbackQuery):
     if data == "delete_lesson_cancel":
         await callback_query.message.edit_text("Deletion cancelled.")
         await callback_query.answer()
-        logging.info(f"User {user_id} cancelled lesson deletion.")
+        logging.info("User %s cancelled lesson deletion.", user_id)
         return
     lesson_id_to_delete = data.split("_", 2)[-1]
-    if user_id not in user_groups or "custom_lessons" not in user_groups[user_id]:
+    user_data = user_groups.get(user_id)
+    if user_data is None:
         await callback_query.message.edit_text("Error: Could not find your lesson data.")
         await callback_query.answer("Error", show_alert=True)
-        logging.error(f"User {user_id} tried to delete lesson {lesson_id_to_delete}, but user data/lessons missing.")
+        logging.error("User %s tried to delete lesson %s, but user data/lessons missing.", user_id, lesson_id_to_delete)
         return
-    initial_lesson_count = len(user_groups[user_id]["custom_lessons"])
-    user_groups[user_id]["custom_lessons"] = [
-        lesson for lesson in user_groups[user_id]["custom_lessons"] if lesson.get("id") != lesson_id_to_delete
+    initial_lesson_count = len(user_data.custom_lessons)
+    user_data.custom_lessons = [
+        lesson for lesson in user_data.custom_lessons if lesson.id != lesson_id_to_delete
     ]
-    if len(user_groups[user_id]["custom_lessons"]) < initial_lesson_count:
-        save_user_data(user_groups)
+    if len(user_data.custom_lessons) < initial_lesson_count:
+        mark_user_data_dirty()
+        mark_reminders_changed(user_id)
         await callback_query.message.edit_text(f"✅ Custom lesson deleted successfully!")
         await callback_query.answer("Lesson deleted")
-        logging.info(f"User {user_id} deleted custom lesson with ID {lesson_id_to_delete}.")
+        logging.info("User %s deleted custom lesson with ID %s.", user_id, lesson_id_to_delete)
     else:
         await callback_query.message.edit_text("Could not find the selected lesson to delete. It might have already been removed.")
         await callback_query.answer("Lesson not found", show_alert=True)
-        logging.warning(f"User {user_id} tried to delete lesson {lesson_id_to_delete}, but it was not found in their list.")
+        logging.warning("User %s tried to delete lesson %s, but it was not found in their list.", user_id, lesson_id_to_delete)
 
 # --- Default Handler ---
 # MUST be registered last (implicitly via decorator order)
@@ -731,175 +1002,265 @@ async def process_custom_lesson_delete(callback_query: CallbackQuery):
 async def handle_other_messages(message: types.Message):
     """Handles unrecognized commands or text when no state is active."""
     user_id = message.from_user.id
-    logging.info(f"Received unrecognized message from {user_id}: '{message.text}'")
+    logging.info("Received unrecognized message from %s: '%s'", user_id, message.text)
     user_data = user_groups.get(user_id)
     if user_data:
-        group_num = user_data.get("group", "Not Set")
-        offset = user_data.get("notification_offset", DEFAULT_NOTIFICATION_OFFSET_MINUTES)
+        group_num = user_data.group
+        offset = user_data.notification_offset
         await message.reply(f"Hi! Your group: {group_num}\nNotify {offset} min before lessons.\n\n"
                           f"I didn't understand that. Use /help to see available commands.")
     else:
         await message.reply("Hello! I didn't understand that. Use /start to register or /help to see commands.")
 
-# --- Notification Logic (check_schedule remains unchanged) ---
+# --- Notification Logic ---
+def room_for_map(room_raw):
+    """Returns the cleaned room to look up a map for, or None for online/unknown rooms."""
+    if isinstance(room_raw, str) and room_raw.strip().upper() == "ONLINE":
+        return None
+    return clean_room_number(room_raw)
+
+@dataclass(slots=True)
+class OfficialLesson:
+    """An official timetable lesson with everything its reminder needs resolved at load time."""
+    start_minute: int
+    lesson_key: str
+    subject: str
+    notification_id: str # Built once so each send reuses one string (and its cached hash) for the dedupe set
+    reminder_body: str # Reminder text below the "Lesson Reminder! (N min)" header
+    room_raw: str | None
+    room_cleaned: str | None
+    photo_file_id: str | None
+
+def text_or_na(value):
+    """Returns a timetable text field as-is, or 'N/A' when it is missing or not a string."""
+    return value if isinstance(value, str) else "N/A"
+
+def build_official_schedule_index(timetable):
+    """Parses official lessons once: group -> day -> [OfficialLesson] sorted by start minute."""
+    index = {}
+    for group_number, days in SORTED_LESSON_KEYS.items(): # Only groups, days and lesson keys that passed validation
+        for day_name, lesson_keys in days.items():
+            day_schedule = timetable[group_number][day_name]
+            lessons = []
+            for lesson_key in lesson_keys:
+                lesson_details = day_schedule[lesson_key]
+                if not isinstance(lesson_details, dict):
+                    logging.warning("No reminders for %s %s lesson %s: malformed entry %r.", group_number, day_name, lesson_key, lesson_details)
+                    continue
+                start_minute = parse_start_minute(lesson_details.get("time"))
+                if start_minute is None:
+                    logging.warning("No reminders for %s %s lesson %s: invalid time %r.", group_number, day_name, lesson_key, lesson_details.get("time"))
+                    continue
+                room_raw = lesson_details.get("room"); room_cleaned = room_for_map(room_raw)
+                subject = text_or_na(lesson_details.get("subject")) # Fields are coerced here, since a bad row must not stop the bot from starting
+                reminder_body = (f"<b>{lesson_key}. {subject}</b> ({text_or_na(lesson_details.get('type')).capitalize()})\n"
+                                 f"🕒 Starts at: {lesson_details['time'].split('-')[0].strip()}\n"
+                                 f"👨‍🏫 Lecturer: {text_or_na(lesson_details.get('lecturer'))}\n"
+                                 f"🚪 Room: {text_or_na(room_raw)}")
+                lessons.append(OfficialLesson(start_minute, lesson_key, subject, f"official_{group_number}_{day_name}_{lesson_key}",
+                                              reminder_body, room_raw, room_cleaned, room_links_data.get(room_cleaned) if room_cleaned else None))
+            lessons.sort(key=lambda lesson: lesson.start_minute)
+            index.setdefault(group_number, {})[day_name] = lessons
+    return index
+
+OFFICIAL_SCHEDULE_INDEX = build_official_schedule_index(timetable_data)
+
+def plan_reminders(now, chat_ids):
+    """Returns queue entries (fire_at, seq, chat_id, generation, kind, lesson) for the given users' reminders still ahead today.
+    lesson is an OfficialLesson or CustomLesson; generation is the user's current reminder_generations value."""
+    queue = []
+    current_day_name = now.strftime('%A')
+    day_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    current_minute = now.hour * 60 + now.minute
+    official_fire_times = {} # (group, offset) -> [(fire_at, OfficialLesson)], shared by users with the same settings
+    for chat_id in chat_ids:
+        user_data = user_groups.get(chat_id)
+        if user_data is None: continue
+        generation = reminder_generations.get(chat_id, 0)
+        offset = user_data.notification_offset
+        group_key = (user_data.group, offset)
+        if group_key not in official_fire_times:
+            day_lessons = OFFICIAL_SCHEDULE_INDEX.get(user_data.group, {}).get(current_day_name, [])
+            first_pending = bisect.bisect_left(day_lessons, current_minute + offset, key=lambda lesson: lesson.start_minute)
+            official_fire_times[group_key] = [
+                (day_start + timedelta(minutes=lesson.start_minute - offset), lesson) for lesson in day_lessons[first_pending:]
+            ]
+        for fire_at, lesson in official_fire_times[group_key]:
+            queue.append((fire_at, next(reminder_seq), chat_id, generation, "official", lesson))
+        for lesson in user_data.custom_lessons:
+            if lesson.day != current_day_name: continue
+            if lesson._start_min - offset >= current_minute:
+                queue.append((day_start + timedelta(minutes=lesson._start_min - offset), next(reminder_seq), chat_id, generation, "custom", lesson))
+    return queue
+
+def build_notification_queue(now):
+    """Plans today's remaining lesson reminders for every user, as a heap ordered by fire time (see plan_reminders)."""
+    queue = plan_reminders(now, user_groups)
+    heapq.heapify(queue)
+    return queue
+
+def replan_user_reminders(notification_queue, now, chat_ids):
+    """Re-plans just these users: their queued reminders go stale (a new generation) and fresh ones are pushed."""
+    for chat_id in chat_ids:
+        reminder_generations[chat_id] = reminder_generations.get(chat_id, 0) + 1
+    for entry in plan_reminders(now, chat_ids):
+        heapq.heappush(notification_queue, entry)
+
+@dataclass(slots=True)
+class DueLesson:
+    """A lesson reminder ready to send: its text and, when the room has a map, the photo it is sent as the caption of."""
+    kind: str # "OFFICIAL" or "CUSTOM", used in logs
+    chat_id: int
+    notification_id: str
+    message: str
+    room_raw: str | None
+    room_cleaned: str | None
+    photo_file_id: str | None
+
+@functools.lru_cache(maxsize=None) # Bounded by the two titles times MAX_OFFSET_MINUTES
+def reminder_header(title, offset):
+    """Returns the bold first line (plus blank line) that precedes every reminder body."""
+    return f"🔔 <b>{title} ({offset} min)</b>\n\n"
+
+def official_due_lesson(chat_id, user_data, lesson):
+    logging.info("Match found: Sending OFFICIAL lesson notification %s (%s) to %s (%s) at %s min offset.", lesson.lesson_key, lesson.subject, chat_id, user_data.group, user_data.notification_offset)
+    message = reminder_header("Lesson Reminder!", user_data.notification_offset) + lesson.reminder_body
+    return DueLesson("OFFICIAL", chat_id, lesson.notification_id, message, lesson.room_raw, lesson.room_cleaned, lesson.photo_file_id)
+
+def custom_due_lesson(chat_id, user_data, lesson):
+    room_stored = lesson.room
+    logging.info("Match found: Sending CUSTOM lesson notification '%s' (ID: %s) to %s at %s min offset.", lesson.subject, lesson.id, chat_id, user_data.notification_offset)
+    message = reminder_header("Custom Reminder!", user_data.notification_offset) + lesson._reminder_body
+    room_cleaned = room_for_map(room_stored)
+    return DueLesson("CUSTOM", chat_id, lesson._notification_id, message, room_stored, room_cleaned, room_links_data.get(room_cleaned) if room_cleaned else None)
+
+async def dispatch_lesson_reminder(due, today_iso):
+    """Sends a reminder once per day, as the room's map photo captioned with the reminder when there is one
+    (one request, and the map can't arrive before the text). A failed send leaves it eligible for retry."""
+    chat_id = due.chat_id
+    if due.notification_id in notified_lessons.get(today_iso, {}).get(chat_id, ()): return
+    try:
+        if due.photo_file_id:
+            try: await send_limited(bot.send_photo, chat_id=chat_id, photo=due.photo_file_id, caption=f"{due.message}\n\n📍 Location map for room {due.room_cleaned}")
+            except TelegramAPIError as e_photo:
+                if is_user_unreachable_error(e_photo): raise
+                logging.error("Notify: Failed to send %s map photo %s for room %s (raw: %s) to %s: %s", due.kind, due.photo_file_id, due.room_cleaned, due.room_raw, chat_id, e_photo)
+                await send_limited(bot.send_message, chat_id, due.message)
+        else:
+            if due.room_cleaned: logging.warning("Notify: No map photo found for %s cleaned room '%s' (raw: '%s') for user %s.", due.kind, due.room_cleaned, due.room_raw, chat_id)
+            await send_limited(bot.send_message, chat_id, due.message)
+        notified_lessons.setdefault(today_iso, {}).setdefault(chat_id, set()).add(due.notification_id)
+        logging.info("Successfully sent %s lesson notification %s", due.kind, due.notification_id)
+    except TelegramAPIError as e:
+        handle_send_error(chat_id, e, f"{due.kind} lesson notification {due.notification_id}")
+    except Exception as e: logging.error("Unexpected error sending %s lesson notification %s to %s: %s", due.kind, due.notification_id, chat_id, e, exc_info=True)
+
+async def dispatch_chat_reminders(dues, today_iso):
+    """Sends one chat's due reminders in queue order, stopping if the chat turns out to be unreachable."""
+    for due in dues:
+        if due.chat_id not in user_groups: return
+        await dispatch_lesson_reminder(due, today_iso)
+
+def next_scheduler_wakeup(now, notification_queue):
+    """Returns when check_schedule next has work: the next queued reminder, today's Learn slot, or midnight (queue rebuild)."""
+    wake_at = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    if notification_queue:
+        wake_at = min(wake_at, notification_queue[0][0])
+    if now.weekday() in LEARN_NOTIFICATION_WEEKDAYS:
+        learn_hour, learn_minute = map(int, LEARN_NOTIFICATION_TIME.split(':'))
+        learn_at = now.replace(hour=learn_hour, minute=learn_minute, second=0, microsecond=0)
+        if learn_at > now: wake_at = min(wake_at, learn_at)
+    return wake_at
+
 async def check_schedule():
-    global notified_lessons, last_learn_notify_sent_key, user_groups
+    """Sends Learn and lesson reminders. Lesson reminders come from a heap of today's fire times that is
+    rebuilt at day rollover and patched per user when their reminders change, so each wake-up only touches reminders that are due."""
+    global last_learn_notify_sent_key
+    notification_queue, queue_date = [], None
     while True:
-        removed_users_in_check = set()
         try:
             now = datetime.now(TIMEZONE)
-            current_day_name = now.strftime('%A')
             current_weekday = now.weekday()
             today_iso = now.date().isoformat()
             current_time_hm = now.strftime("%H:%M")
             current_minute_key = f"{today_iso}-{current_time_hm}"
 
             # --- Daily Cleanup ---
-            if now.time() < dt_time(0, 5):
-                if not hasattr(check_schedule, 'last_cleared_date') or check_schedule.last_cleared_date != today_iso:
-                    logging.info(f"Performing daily cleanup for {today_iso}. Current notified_lessons count: {len(notified_lessons)}")
-                    notified_lessons_before = len(notified_lessons)
-                    notified_lessons = {n for n in notified_lessons if n[1] >= today_iso}
-                    check_schedule.last_cleared_date = today_iso
-                    logging.info(f"Notified lessons cleaned up. Count before: {notified_lessons_before}, after: {len(notified_lessons)}")
+            stale_dates = [d for d in notified_lessons if d < today_iso]
+            if stale_dates:
+                for d in stale_dates: del notified_lessons[d]
+                logging.info("Performing daily cleanup for %s. Dropped notified lessons for: %s", today_iso, ", ".join(stale_dates))
 
             # --- 1. Learn Platform Notification Check ---
-            if current_weekday in [0, 2, 4] and current_time_hm == "19:40":
+            if current_weekday in LEARN_NOTIFICATION_WEEKDAYS and current_time_hm == LEARN_NOTIFICATION_TIME:
                 if last_learn_notify_sent_key != current_minute_key:
-                    logging.info(f"Time matched for Learn notification ({current_minute_key}). Checking users.")
-                    users_to_notify_learn = []
-                    current_users_copy = dict(user_groups)
-                    for user_id, user_data in current_users_copy.items():
-                        if user_data.get("learn_notify", False): users_to_notify_learn.append(user_id)
+                    logging.info("Time matched for Learn notification (%s). Checking users.", current_minute_key)
+                    users_to_notify_learn = [user_id for user_id, user_data in user_groups.items() if user_data.learn_notify]
                     if users_to_notify_learn:
-                        logging.info(f"Sending Learn notification to {len(users_to_notify_learn)} users.")
+                        logging.info("Sending Learn notification to %s users.", len(users_to_notify_learn))
                         sent_count = 0
-                        for chat_id in users_to_notify_learn:
-                             if chat_id in user_groups and user_groups[chat_id].get("learn_notify"):
-                                try:
-                                    await bot.send_message(chat_id, LEARN_NOTIFICATION_TEXT)
-                                    sent_count += 1; await asyncio.sleep(LEARN_NOTIFICATION_DELAY)
-                                except TelegramAPIError as e:
-                                    logging.error(f"Failed to send Learn notification to {chat_id}: {e}")
-                                    if "blocked" in str(e).lower() or "deactivated" in str(e).lower() or "chat not found" in str(e).lower() or "user is deactivated" in str(e).lower():
-                                        logging.warning(f"Removing user {chat_id} due to error during Learn notification.")
-                                        if user_groups.pop(chat_id, None):
-                                            save_user_data(user_groups); notified_lessons = {n for n in notified_lessons if n[0] != chat_id}
-                                            timetable_usage.pop(chat_id, None); find_usage.pop(chat_id, None)
-                                            removed_users_in_check.add(chat_id)
-                                except Exception as e: logging.error(f"Unexpected error sending Learn notification to {chat_id}: {e}", exc_info=True)
-                        logging.info(f"Finished sending Learn notifications. Sent: {sent_count}")
+
+                        async def send_learn(chat_id):
+                            nonlocal sent_count
+                            try:
+                                await send_limited(bot.send_message, chat_id, LEARN_NOTIFICATION_TEXT)
+                                sent_count += 1
+                            except TelegramAPIError as e: handle_send_error(chat_id, e, "Learn notification")
+                            except Exception as e: logging.error("Unexpected error sending Learn notification to %s: %s", chat_id, e, exc_info=True)
+
+                        # Sends run concurrently; global_send_limiter keeps the fan-out under Telegram's rate cap
+                        await asyncio.gather(*(send_learn(chat_id) for chat_id in users_to_notify_learn))
+                        logging.info("Finished sending Learn notifications. Sent: %s", sent_count)
                     else: logging.info("No users opted-in for Learn notifications at this time.")
                     last_learn_notify_sent_key = current_minute_key
 
             # --- 2. Lesson Reminder Notification Check (Official & Custom) ---
-            users_data_list = list(user_groups.items())
-            for chat_id, user_data in users_data_list:
-                if chat_id in removed_users_in_check or chat_id not in user_groups: continue
-                user_notification_offset = user_data.get("notification_offset", DEFAULT_NOTIFICATION_OFFSET_MINUTES)
-                notify_time_target = now + timedelta(minutes=user_notification_offset)
-                notify_target_hour = notify_time_target.hour; notify_target_minute = notify_time_target.minute
-
-                # --- A. Check Official Schedule ---
-                group_number = user_data.get("group")
-                if group_number and timetable_data and group_number in timetable_data:
-                    group_schedule = timetable_data.get(group_number, {}); day_schedule = group_schedule.get(current_day_name, {})
-                    if day_schedule:
-                        for lesson_key, lesson_details in day_schedule.items():
-                            if chat_id not in user_groups or chat_id in removed_users_in_check: break
-                            try:
-                                time_range = lesson_details.get("time"); room_raw = lesson_details.get("room")
-                                subject = lesson_details.get("subject", "N/A"); lesson_type = lesson_details.get("type", "N/A").capitalize()
-                                lecturer = lesson_details.get("lecturer", "N/A")
-                                if not time_range or not isinstance(time_range, str): continue
-                                start_time_str = time_range.split('-')[0].strip()
-                                if not is_valid_time_format(start_time_str): continue
-                                lesson_hour, lesson_minute = map(int, start_time_str.split(':'))
-                                if lesson_hour == notify_target_hour and lesson_minute == notify_target_minute:
-                                    notification_id = (chat_id, today_iso, f"official_{group_number}_{current_day_name}_{lesson_key}")
-                                    if notification_id in notified_lessons: continue
-                                    logging.info(f"Match found: Sending OFFICIAL lesson notification {lesson_key} ({subject}) to {chat_id} ({group_number}) at {user_notification_offset} min offset.")
-                                    is_online = isinstance(room_raw, str) and room_raw.strip().upper() == "ONLINE"; room_cleaned = None
-                                    if not is_online: room_cleaned = clean_room_number(room_raw)
-                                    base_message = (f"🔔 <b>Lesson Reminder! ({user_notification_offset} min)</b>\n\n"
-                                                    f"<b>{lesson_key}. {subject}</b> ({lesson_type})\n"
-                                                    f"🕒 Starts at: {start_time_str}\n"
-                                                    f"👨‍🏫 Lecturer: {lecturer}\n"
-                                                    f"🚪 Room: {room_raw if isinstance(room_raw, str) else 'N/A'}")
-                                    try:
-                                        await bot.send_message(chat_id, base_message); notified_lessons.add(notification_id); await asyncio.sleep(RATE_LIMIT_DELAY)
-                                        if not is_online and room_cleaned and room_links_data:
-                                            photo_file_id = room_links_data.get(room_cleaned)
-                                            if photo_file_id:
-                                                try: await bot.send_photo(chat_id=chat_id, photo=photo_file_id, caption=f"📍 Location map for room {room_cleaned}"); await asyncio.sleep(RATE_LIMIT_DELAY)
-                                                except TelegramAPIError as e_photo: logging.error(f"Notify: Failed to send OFFICIAL map photo {photo_file_id} for room {room_cleaned} (raw: {room_raw}) to {chat_id}: {e_photo}")
-                                            else: logging.warning(f"Notify: No map photo found for OFFICIAL cleaned room '{room_cleaned}' (raw: '{room_raw}') for user {chat_id}.")
-                                        logging.info(f"Successfully sent OFFICIAL lesson notification {notification_id}")
-                                    except TelegramAPIError as e:
-                                        logging.error(f"API Error sending OFFICIAL lesson notification part to {chat_id} (ID: {notification_id}): {e}"); notified_lessons.discard(notification_id)
-                                        if "blocked" in str(e).lower() or "deactivated" in str(e).lower() or "chat not found" in str(e).lower() or "user is deactivated" in str(e).lower():
-                                            logging.warning(f"Removing user {chat_id} due to error during OFFICIAL lesson notification.")
-                                            if user_groups.pop(chat_id, None):
-                                                save_user_data(user_groups); notified_lessons = {n for n in notified_lessons if n[0] != chat_id}
-                                                timetable_usage.pop(chat_id, None); find_usage.pop(chat_id, None); removed_users_in_check.add(chat_id); break
-                                    except Exception as e: notified_lessons.discard(notification_id); logging.error(f"Unexpected error sending OFFICIAL lesson notification part for {chat_id} / lesson {lesson_key}: {e}", exc_info=True)
-                            except Exception as e: logging.error(f"Error processing inner loop for OFFICIAL lesson {lesson_key}, user {chat_id}, group {group_number}: {e}", exc_info=True)
-
-                # --- B. Check Custom Schedule ---
-                custom_lessons = user_data.get("custom_lessons", [])
-                if custom_lessons:
-                    for lesson in custom_lessons:
-                        if chat_id not in user_groups or chat_id in removed_users_in_check: break
-                        try:
-                            lesson_day = lesson.get("day"); start_time_str = lesson.get("start_time"); lesson_id = lesson.get("id")
-                            subject = lesson.get("subject", "N/A"); room_stored = lesson.get("room", "N/A"); end_time_str = lesson.get("end_time", "N/A")
-                            if not lesson_day or lesson_day != current_day_name or not start_time_str or not lesson_id or not is_valid_time_format(start_time_str): continue
-                            lesson_hour, lesson_minute = map(int, start_time_str.split(':'))
-                            if lesson_hour == notify_target_hour and lesson_minute == notify_target_minute:
-                                notification_id = (chat_id, today_iso, f"custom_{lesson_id}")
-                                if notification_id in notified_lessons: continue
-                                logging.info(f"Match found: Sending CUSTOM lesson notification '{subject}' (ID: {lesson_id}) to {chat_id} at {user_notification_offset} min offset.")
-                                is_online = room_stored.upper() == "ONLINE"; room_cleaned = None
-                                if not is_online: room_cleaned = clean_room_number(room_stored)
-                                base_message = (f"🔔 <b>Custom Reminder! ({user_notification_offset} min)</b>\n\n"
-                                                f"📌 Subject: <b>{subject}</b>\n"
-                                                f"🕒 Starts at: {start_time_str} (Ends: {end_time_str})\n"
-                                                f"🚪 Room: {room_stored}")
-                                try:
-                                    await bot.send_message(chat_id, base_message); notified_lessons.add(notification_id); await asyncio.sleep(RATE_LIMIT_DELAY)
-                                    if not is_online and room_cleaned and room_links_data:
-                                        photo_file_id = room_links_data.get(room_cleaned)
-                                        if photo_file_id:
-                                            try: await bot.send_photo(chat_id=chat_id, photo=photo_file_id, caption=f"📍 Location map for room {room_cleaned}"); await asyncio.sleep(RATE_LIMIT_DELAY)
-                                            except TelegramAPIError as e_photo: logging.error(f"Notify: Failed to send CUSTOM map photo {photo_file_id} for room {room_cleaned} (stored: {room_stored}) to {chat_id}: {e_photo}")
-                                        else: logging.warning(f"Notify: No map photo found for CUSTOM cleaned room '{room_cleaned}' (stored: '{room_stored}') for user {chat_id}.")
-                                    logging.info(f"Successfully sent CUSTOM lesson notification {notification_id}")
-                                except TelegramAPIError as e:
-                                    logging.error(f"API Error sending CUSTOM lesson notification part to {chat_id} (ID: {notification_id}): {e}"); notified_lessons.discard(notification_id)
-                                    if "blocked" in str(e).lower() or "deactivated" in str(e).lower() or "chat not found" in str(e).lower() or "user is deactivated" in str(e).lower():
-                                        logging.warning(f"Removing user {chat_id} due to error during CUSTOM lesson notification.")
-                                        if user_groups.pop(chat_id, None):
-                                            save_user_data(user_groups); notified_lessons = {n for n in notified_lessons if n[0] != chat_id}
-                                            timetable_usage.pop(chat_id, None); find_usage.pop(chat_id, None); removed_users_in_check.add(chat_id); break
-                                except Exception as e: notified_lessons.discard(notification_id); logging.error(f"Unexpected error sending CUSTOM lesson notification part for {chat_id} / lesson ID {lesson_id}: {e}", exc_info=True)
-                        except Exception as e: logging.error(f"Error processing inner loop for CUSTOM lesson (ID: {lesson.get('id', 'UNKNOWN')}), user {chat_id}: {e}", exc_info=True)
+            if queue_date != today_iso:
+                schedule_changed.clear(); reminder_replan_users.clear() # The full rebuild reads everyone's current settings
+                notification_queue, queue_date = build_notification_queue(now), today_iso
+            elif schedule_changed.is_set():
+                schedule_changed.clear()
+                replan_users = list(reminder_replan_users); reminder_replan_users.clear()
+                replan_user_reminders(notification_queue, now, replan_users)
+            due_reminders = {} # chat_id -> [DueLesson] in fire order
+            while notification_queue and notification_queue[0][0] <= now:
+                _, _, chat_id, generation, kind, lesson = heapq.heappop(notification_queue)
+                if generation != reminder_generations.get(chat_id, 0): continue # Superseded by a re-plan
+                user_data = user_groups.get(chat_id)
+                if user_data is None: continue
+                # Queued lessons were validated at load (official index, CustomLesson), so no per-entry guard here
+                if kind == "official": due = official_due_lesson(chat_id, user_data, lesson)
+                else: due = custom_due_lesson(chat_id, user_data, lesson)
+                due_reminders.setdefault(chat_id, []).append(due)
+            if due_reminders:
+                # Chats are served concurrently (a slow chat doesn't hold up the rest), paced by global_send_limiter
+                results = await asyncio.gather(*(dispatch_chat_reminders(dues, today_iso) for dues in due_reminders.values()), return_exceptions=True)
+                for result in results:
+                    if isinstance(result, Exception): logging.error("Error processing lesson reminder: %s", result, exc_info=result)
 
         except Exception as e:
-            logging.critical(f"CRITICAL ERROR in check_schedule main loop: {e}", exc_info=True)
-            await asyncio.sleep(CHECK_INTERVAL_SECONDS * 2)
-        await asyncio.sleep(CHECK_INTERVAL_SECONDS)
+            logging.critical("CRITICAL ERROR in check_schedule main loop: %s", e, exc_info=True)
+            await asyncio.sleep(SCHEDULER_ERROR_BACKOFF_SECONDS)
+        # Sleep until just after the next thing to do (all wake-up times are whole minutes), or until a user's reminders change
+        now = datetime.now(TIMEZONE)
+        sleep_for = min(max(0.0, (next_scheduler_wakeup(now, notification_queue) - now).total_seconds()) + 0.2, SCHEDULER_MAX_SLEEP_SECONDS)
+        try: await asyncio.wait_for(schedule_changed.wait(), timeout=sleep_for)
+        except asyncio.TimeoutError: pass
 
 # --- Main Execution ---
 async def main():
     global user_groups
-    user_groups = load_user_data()
-    logging.info(f"Loaded {len(user_groups)} users from {USER_DATA_FILE}")
+    user_groups = await load_user_data_async()
+    logging.info("Loaded %s users from %s", len(user_groups), USER_DATA_FILE)
+    bot_user = await bot.get_me() # Opens the HTTPS connection before the first reminder; fails fast on a bad token
+    logging.info("Connected to Telegram as @%s", bot_user.username)
 
     # REMOVED explicit handler registration from here.
     # Relying solely on decorators placed above each handler function.
 
     scheduler_task = asyncio.create_task(check_schedule(), name="ScheduleChecker")
-    logging.info("Background scheduler task created.")
+    flush_task = asyncio.create_task(flush_user_data_periodically(), name="UserDataFlusher")
+    logging.info("Background scheduler and user data flush tasks created.")
     logging.info("Starting bot polling...")
 
     try:
@@ -909,9 +1270,12 @@ async def main():
         scheduler_task.cancel()
         try: await scheduler_task
         except asyncio.CancelledError: logging.info("Scheduler task cancelled successfully.")
-        except Exception as e: logging.error(f"Error during scheduler task cancellation: {e}", exc_info=True)
-        save_user_data(user_groups)
-        logging.info(f"Final user data saved. Bot polling stopped.")
+        except Exception as e: logging.error("Error during scheduler task cancellation: %s", e, exc_info=True)
+        flush_task.cancel()
+        try: await flush_task
+        except asyncio.CancelledError: pass
+        await save_user_data_async(user_groups)
+        logging.info("Final user data saved. Bot polling stopped.")
 
 if __name__ == '__main__':
     try:
@@ -919,4 +1283,4 @@ if __name__ == '__main__':
     except KeyboardInterrupt:
         logging.info("Shutdown requested via KeyboardInterrupt.")
     except Exception as e:
-        logging.error(f"Unhandled exception in main execution scope: {e}", exc_info=True)
\ No newline at end of file
+        logging.error("Unhandled exception in main execution scope: %s", e, exc_info=True)
\ No newline at end of file